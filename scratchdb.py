@@ -1,10 +1,13 @@
 ### A simple key-value database that supports set, get, and pop operations.
 
 import ast
+import heapq
+import itertools
 import os
 import pickle
 import struct
 import sys
+import time
 
 
 # The physical layer
@@ -157,9 +160,32 @@ class FileStorage(object):
         self._zero_end()
         return last_address
 
+    def append_many(self, datas):
+        """
+        Writes all the data at the end of the file with a single write. Returns
+        a list with the address of each piece of data in the file.
+        """
+        self._seek_formatted_data_end()
+        address = self._tell()
+        addresses = []
+        chunks = []
+        for data in datas:
+            length = len(data) + self.INTEGER_LENGTH
+            addresses.append(address)
+            chunks.append(struct.pack(self.INTEGER_FORMAT, length))
+            chunks.append(data)
+            address += length
+        self._write(b''.join(chunks))
+        self._zero_end()
+        return addresses
+
     def close(self):
         self._f.close()
 
+    def sync(self):
+        """Forces the data written so far to disk."""
+        os.fsync(self._f.fileno())
+
     @property
     def is_open(self):
         return not self.is_closed
@@ -188,53 +214,367 @@ class FileStorage(object):
 # The logical layer
 class Logical(object):
     def __init__(self, dbname):
-        self._keys_storage = FileStorage(dbname + '.keys')
-        self._values_storage = FileStorage(dbname + '.values')
+        self._dbname = dbname
+        self._generation = self._read_generation()
+        self._remove_stale_generations()
+        self._open_storage()
+        # min-heap of (expires_at, n, key) used to tell whether any key is due
+        # without scanning the whole keys file, n breaks ties between keys
+        # that cannot be compared. it is loaded by the first write or expire()
+        # so that opening a database does not have to read all the keys
+        self._expiry_heap = None
+        self._expiry_counter = itertools.count()
+        # the latest expiry of every key, used to skip heap entries that went
+        # stale because their key was set again or popped
+        self._expiries = None
+        self._unhashable_expiries = None
+
+    def _filename(self, ext, generation=None):
+        """
+        Returns the name of the storage file with the given extension.
+        Compaction writes every generation of the files under new names,
+        generation 0 uses the plain names.
+        """
+        if generation is None:
+            generation = self._generation
+        if generation == 0:
+            return self._dbname + ext
+        return '%s%s.%d' % (self._dbname, ext, generation)
+
+    def _read_generation(self):
+        try:
+            with open(self._dbname + '.generation') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _write_generation(self, generation):
+        """
+        Atomically makes generation the active pair of storage files. This is
+        the point at which a compaction takes effect.
+        """
+        filename = self._dbname + '.generation'
+        with open(filename + '.tmp', 'w') as f:
+            f.write(str(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + '.tmp', filename)
+
+    def _sync_dir(self):
+        """Forces renames and new files in the database directory to disk."""
+        fd = os.open(os.path.dirname(os.path.abspath(self._dbname)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _remove_files(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def _remove_stale_generations(self):
+        # compaction always goes from one generation to the next, so an
+        # interrupted compaction can only leave the files of the next
+        # generation (not committed) or of the previous one (committed)
+        stale = [self._dbname + '.generation.tmp']
+        for generation in [self._generation - 1, self._generation + 1]:
+            if generation >= 0:
+                stale += [self._filename(ext, generation) for ext in ['.keys', '.values']]
+        self._remove_files(stale)
+
+    def _open_storage(self):
+        self._keys_storage = FileStorage(self._filename('.keys'))
+        self._values_storage = FileStorage(self._filename('.values'))
+
+    def _now(self):
+        return time.time()
 
     def _read_keys(self):
+        # walk the records in order using their lengths rather than calling
+        # next_address(), which scans from the start of the file every time
         keys = []
         address = 0
-        while address is not None:
+        key_data = self._keys_storage.read(address)
+        while key_data is not None:
+            key = pickle.loads(key_data)
+            keys.append(key)
+            address += len(key_data) + self._keys_storage.INTEGER_LENGTH
             key_data = self._keys_storage.read(address)
-            if key_data is not None:
-                key = pickle.loads(key_data)
-                keys.append(key)
-            address = self._keys_storage.next_address(address)
         return keys
 
-    def _insert(self, key, value, for_deletion=False):
+    def _latest_records(self, keys):
+        """
+        Returns a list of (key, value_address, expires_at) with the latest
+        record for every key in keys, as returned by _read_keys(). Popped keys
+        are included with a value_address of None.
+        """
+        records = {}
+        unhashable = []
+        for key, value_address, *rest in keys:
+            record = (key, value_address, rest[0] if rest else None)
+            try:
+                records[key] = record
+            except TypeError:
+                # unhashable keys are matched with == like get() does
+                for i, (k, *_) in enumerate(unhashable):
+                    if k == key:
+                        unhashable[i] = record
+                        break
+                else:
+                    unhashable.append(record)
+        return list(records.values()) + unhashable
+
+    def _get_expiry(self, key):
+        try:
+            return self._expiries.get(key)
+        except TypeError:
+            for k, expires_at in self._unhashable_expiries:
+                if k == key:
+                    return expires_at
+            return None
+
+    def _set_expiry(self, key, expires_at):
+        """
+        Records expires_at as the latest expiry of key, None meaning that the
+        key does not expire or was popped.
+        """
+        try:
+            hash(key)
+        except TypeError:
+            self._unhashable_expiries = [
+                (k, e) for k, e in self._unhashable_expiries if k != key
+            ]
+            if expires_at is not None:
+                self._unhashable_expiries.append((key, expires_at))
+        else:
+            if expires_at is None:
+                self._expiries.pop(key, None)
+            else:
+                self._expiries[key] = expires_at
+        if expires_at is not None:
+            entry = (expires_at, next(self._expiry_counter), key)
+            heapq.heappush(self._expiry_heap, entry)
+
+    def _load_expiries(self, records):
+        """
+        Rebuilds the expiry heap from a list of (key, value_address,
+        expires_at) records as returned by _latest_records().
+        """
+        self._expiry_heap = []
+        self._expiries = {}
+        self._unhashable_expiries = []
+        for key, value_address, expires_at in records:
+            if value_address is not None and expires_at is not None:
+                self._set_expiry(key, expires_at)
+
+    def _track_writes(self, records):
+        """
+        Updates the expiry heap with the (key, expires_at) records that were
+        just written and reclaims expired keys if any are due. The first write
+        loads the heap from the keys file, which already has the records.
+        """
+        if self._expiry_heap is None:
+            self._load_expiries(self._latest_records(self._read_keys()))
+        else:
+            for key, expires_at in records:
+                self._set_expiry(key, expires_at)
+        self._expire_if_due()
+
+    def _expire_if_due(self):
+        if self._expiry_heap and self._expiry_heap[0][0] <= self._now():
+            self.expire()
+
+    def _insert(self, key, value, for_deletion=False, ttl=None):
         if not for_deletion:
             value_data = pickle.dumps(value)
             value_address = self._values_storage.append(value_data)
         else:
             value_address = None
-        key_tuple = (key, value_address)
+        if ttl is None:
+            expires_at = None
+            key_tuple = (key, value_address)
+        else:
+            expires_at = self._now() + ttl
+            key_tuple = (key, value_address, expires_at)
         key_data = pickle.dumps(key_tuple)
         key_address = self._keys_storage.append(key_data)
+        self._track_writes([(key, expires_at)])
+
+    def _compact(self, now):
+        """
+        Rewrites the storage files keeping only the latest, unexpired record
+        of every key. Returns the number of keys that expired at or before now.
+
+        The compacted data is written to the files of the next generation,
+        which only replace the current ones once _write_generation() commits
+        them, so a failure at any point leaves a usable database.
+        """
+        live = []
+        expired = 0
+        for key, value_address, expires_at in self._latest_records(self._read_keys()):
+            if value_address is None:
+                continue
+            if expires_at is not None and expires_at <= now:
+                expired += 1
+            else:
+                live.append((key, value_address, expires_at))
+
+        value_datas = [
+            self._values_storage.read(value_address)
+            for key, value_address, expires_at in live
+        ]
+        generation = self._generation + 1
+        filenames = [self._filename(ext, generation) for ext in ['.keys', '.values']]
+        self._remove_files(filenames)
+        keys_storage = FileStorage(filenames[0])
+        values_storage = FileStorage(filenames[1])
+        try:
+            value_addresses = values_storage.append_many(value_datas)
+            key_datas = []
+            for (key, _, expires_at), value_address in zip(live, value_addresses):
+                if expires_at is None:
+                    key_tuple = (key, value_address)
+                else:
+                    key_tuple = (key, value_address, expires_at)
+                key_datas.append(pickle.dumps(key_tuple))
+            keys_storage.append_many(key_datas)
+            keys_storage.sync()
+            values_storage.sync()
+            self._sync_dir()
+            self._write_generation(generation)
+        except Exception:
+            keys_storage.close()
+            values_storage.close()
+            self._remove_files(filenames)
+            raise
+
+        old_filenames = [self._filename(ext) for ext in ['.keys', '.values']]
+        self.close_storage()
+        self._keys_storage = keys_storage
+        self._values_storage = values_storage
+        self._generation = generation
+        self._load_expiries(live)
+        self._sync_dir()
+        try:
+            self._remove_files(old_filenames)
+        except OSError:
+            pass  # they are removed the next time the database is opened
+        return expired
 
     def get(self, key):
         # the key_data type is determined in _insert(), it's a tuple:
-        # (key, value_address)
+        # (key, value_address) or (key, value_address, expires_at)
         # note that we do updates by inserting another copy of the key.
         # this means that to retrieve the key we have to look at all of them
         keys = self._read_keys()
-        value_data = None
-        for k, value_address in keys:
+        value_address = None
+        expires_at = None
+        for k, address, *rest in keys:
             if k == key:
-                if value_address is None:
-                    value_data = None
-                else:
-                    value_data = self._values_storage.read(value_address)
-        if value_data is None:
+                value_address = address
+                expires_at = rest[0] if rest else None
+        # expired keys are treated as absent without reading the value
+        if expires_at is not None and expires_at <= self._now():
+            value_address = None
+        if value_address is None:
             raise KeyError('Key %s not found' % str(key))
+        value_data = self._values_storage.read(value_address)
         return pickle.loads(value_data)
 
-    def set(self, key, value):
-        return self._insert(key, value, for_deletion=False)
+    def set(self, key, value, ttl=None):
+        if ttl is not None and ttl <= 0:
+            raise ValueError('ttl should be a positive number of seconds')
+        return self._insert(key, value, for_deletion=False, ttl=ttl)
 
     def pop(self, key):
         return self._insert(key, value=None, for_deletion=True)
 
+    def set_many(self, items, ttl=None):
+        """
+        Sets every (key, value) pair in items, writing all the values and then
+        all the keys with one append each.
+        """
+        if ttl is not None and ttl <= 0:
+            raise ValueError('ttl should be a positive number of seconds')
+        items = list(items)
+        value_datas = [pickle.dumps(value) for key, value in items]
+        value_addresses = self._values_storage.append_many(value_datas)
+        if ttl is None:
+            expires_at = None
+            key_tuples = [
+                (key, value_address)
+                for (key, value), value_address in zip(items, value_addresses)
+            ]
+        else:
+            expires_at = self._now() + ttl
+            key_tuples = [
+                (key, value_address, expires_at)
+                for (key, value), value_address in zip(items, value_addresses)
+            ]
+        self._keys_storage.append_many([pickle.dumps(kt) for kt in key_tuples])
+        self._track_writes([(key, expires_at) for key, value in items])
+
+    def get_many(self, keys, default=None):
+        """
+        Looks up all the keys with a single read of the keys file. Returns a
+        list with the value of each key, or default for keys that are not
+        found. Keys are matched with == like get() does.
+        """
+        records = self._read_keys()
+        # hashable keys are looked up in a dict of their latest records,
+        # unhashable ones fall back to scanning the records like get()
+        latest = {}
+        for k, value_address, *rest in records:
+            try:
+                latest[k] = (value_address, rest[0] if rest else None)
+            except TypeError:
+                pass
+        now = self._now()
+        values = []
+        for key in keys:
+            try:
+                value_address, expires_at = latest.get(key, (None, None))
+            except TypeError:
+                value_address, expires_at = None, None
+                for k, address, *rest in records:
+                    if k == key:
+                        value_address = address
+                        expires_at = rest[0] if rest else None
+            if expires_at is not None and expires_at <= now:
+                value_address = None
+            if value_address is None:
+                values.append(default)
+            else:
+                value_data = self._values_storage.read(value_address)
+                values.append(pickle.loads(value_data))
+        return values
+
+    def expire(self):
+        """
+        Reclaims the storage used by expired keys. All keys that are due are
+        removed in a single compaction of the storage files rather than one
+        pop at a time, popped keys are dropped in the same pass. Returns the
+        number of keys that expired.
+
+        Writes call expire() themselves whenever a key is due, so this only
+        needs to be called to reclaim storage without writing.
+        """
+        if self._expiry_heap is None:
+            self._load_expiries(self._latest_records(self._read_keys()))
+        now = self._now()
+        due = False
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(self._expiry_heap)
+            # the entry is stale if the key was set again or popped since
+            if self._get_expiry(key) == expires_at:
+                due = True
+        if not due:
+            return 0
+        return self._compact(now)
+
     def close_storage(self):
         self._keys_storage.close()
         self._values_storage.close()
@@ -248,17 +588,35 @@ class ScratchDB(object):
     def get(self, key):
         return self._ds.get(key)
 
-    def set(self, key, value):
-        return self._ds.set(key, value)
+    def set(self, key, value, ttl=None):
+        return self._ds.set(key, value, ttl=ttl)
 
     def pop(self, key):
         return self._ds.pop(key)
 
+    def set_many(self, items, ttl=None):
+        return self._ds.set_many(items, ttl=ttl)
+
+    def get_many(self, keys, default=None):
+        return self._ds.get_many(keys, default=default)
+
+    def expire(self):
+        """
+        Removes expired keys from storage and returns how many there were.
+        Expired keys are never returned by get(). set() and pop() reclaim
+        their storage once they are due, call this to reclaim it without
+        writing.
+        """
+        return self._ds.expire()
+
     def close(self):
         return self._ds.close_storage()
 
 
 class QueryProcessor(object):
+    # returned by ScratchDB.get_many() for keys that are not found
+    _NOT_FOUND = object()
+
     def __init__(self, db):
         self._db = db
 
@@ -275,6 +633,27 @@ class QueryProcessor(object):
     def _format(self, v):
         return '<%s>: %s' % (type(v).__name__, v)
 
+    def _parse(self, user_input):
+        """
+        Splits the user input into a (cmd, key_string, args) tuple. Returns an
+        error message string instead if the input is not a valid query.
+        """
+        if not user_input.split():
+            return 'Invalid query. The query is empty.'
+        cmd, *rest = user_input.split()
+        if not self._validate_cmd(cmd):
+            return 'Invalid query. %s is not a ScratchDB command.' % cmd
+        if not rest:
+            return 'Invalid query. %s should have a key.' % cmd
+        key_string, *args = rest
+        if cmd == 'get' and args:
+            return 'Invalid query. get should only have one argument, the key to get.'
+        elif cmd == 'set' and not args:
+            return 'Invalid query. set should have 2 arguments, the key to set and the value to set it to.'
+        elif cmd == 'pop' and args:
+            return 'Invalid query. pop should only have one argument, the key to pop.'
+        return cmd, key_string, args
+
     def _handle_get(self, key_string):
         key = self._to_python(key_string)
         try:
@@ -294,55 +673,144 @@ class QueryProcessor(object):
         self._db.pop(key)
         return 'Key popped: %s' % key_string
 
+    def _handle_get_many(self, key_strings):
+        keys = [self._to_python(key_string) for key_string in key_strings]
+        vals = self._db.get_many(keys, default=self._NOT_FOUND)
+        return [
+            'Key not found: %s' % key_string if val is self._NOT_FOUND
+            else self._format(val)
+            for key_string, val in zip(key_strings, vals)
+        ]
+
+    def _handle_set_many(self, key_strings, args_list):
+        items = [
+            (self._to_python(key_string), self._to_python(''.join(args)))
+            for key_string, args in zip(key_strings, args_list)
+        ]
+        self._db.set_many(items)
+        return [
+            'Set key %s to %s' % (self._format(key), self._format(value))
+            for key, value in items
+        ]
+
     def execute(self, user_input):
         """
         Accepts a string as provided by the user and returns the output that
         should be displayed. The return value is a string with the result of
         the query or an error message.
         """
-        cmd, key_string, *args = user_input.split()
-        if not self._validate_cmd(cmd):
-            return 'Invalid query. %s is not a ScratchDB command.' % cmd
+        query = self._parse(user_input)
+        if isinstance(query, str):
+            return query
+        cmd, key_string, args = query
         if cmd == 'get':
-            if args:
-                return 'Invalid query. get should only have one argument, the key to get.'
             return self._handle_get(key_string)
         elif cmd == 'set':
-            if not args:
-                return 'Invalid query. set should have 2 arguments, the key to set and the value to set it to.'
             return self._handle_set(key_string, args)
         elif cmd == 'pop':
-            if args:
-                return 'Invalid query. pop should only have one argument, the key to pop.'
             return self._handle_pop(key_string)
 
+    def execute_many(self, user_inputs):
+        """
+        Accepts an iterable of strings, one query each, and returns a list with
+        the output of every query in the same order. Blank lines are skipped.
+        Consecutive sets are written as one batch and consecutive gets are
+        looked up in one pass over the keys.
+        """
+        queries = [self._parse(s) for s in user_inputs if s.strip()]
+        outputs = []
+        for cmd, group in itertools.groupby(
+                queries, key=lambda q: None if isinstance(q, str) else q[0]):
+            group = list(group)
+            if cmd == 'get':
+                outputs.extend(self._handle_get_many([q[1] for q in group]))
+            elif cmd == 'set':
+                outputs.extend(self._handle_set_many(
+                    [q[1] for q in group], [q[2] for q in group]))
+            elif cmd == 'pop':
+                outputs.extend(self._handle_pop(q[1]) for q in group)
+            else:
+                outputs.extend(group)
+        return outputs
+
 
 class Client(object):
+    # number of lines read, executed and printed at a time in batch mode
+    BATCH_SIZE = 1000
+
     def __init__(self):
         args = sys.argv[1:]
-        if len(args) != 1:
+        if len(args) == 3 and args[1] == '--exec':
+            self._exec_filename = args[2]
+        elif len(args) == 1:
+            self._exec_filename = None
+        else:
             self.print_usage()
             sys.exit()
         dbname = args[0]
         self._db = ScratchDB(dbname)
         self._qp = QueryProcessor(self._db)
 
+    def run(self):
+        if self._exec_filename is None and sys.stdin.isatty():
+            self.run_repl()
+        else:
+            self.run_batch()
+
     def run_repl(self):
          print('Use Ctrl-D to exit.')
          while True:
              try:
                 user_input = input('[scratchdb]=> ')
+                if not user_input.strip():
+                    continue
                 output = self._qp.execute(user_input)
                 print('  ' + output)
              except (EOFError, KeyboardInterrupt):
                 sys.exit()
 
+    def run_batch(self):
+        if self._exec_filename in (None, '-'):
+            f = sys.stdin
+        else:
+            try:
+                f = open(self._exec_filename)
+            except OSError as e:
+                print('Cannot read %s: %s' % (self._exec_filename, e.strerror),
+                      file=sys.stderr)
+                self._db.close()
+                sys.exit(1)
+        # queries are read in chunks so that memory stays bounded and output
+        # shows up while a long file is being replayed
+        n_queries = 0
+        t_s = time.perf_counter()
+        try:
+            user_inputs = list(itertools.islice(f, self.BATCH_SIZE))
+            while user_inputs:
+                outputs = self._qp.execute_many(user_inputs)
+                for output in outputs:
+                    print(output)
+                sys.stdout.flush()
+                n_queries += len(outputs)
+                user_inputs = list(itertools.islice(f, self.BATCH_SIZE))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            self._db.close()
+        elapsed = time.perf_counter() - t_s
+        rate = n_queries / elapsed if elapsed > 0 else float('inf')
+        print('Processed %d queries, invalid ones included, in %.3fs (%.0f queries/s).'
+              % (n_queries, elapsed, rate), file=sys.stderr)
+
     def print_usage(self):
-        print('Usage: python scratchdb <database name>.')
+        print('Usage: python scratchdb <database name> [--exec <file>].')
         print('Necessary files will be created if they do not exist.')
+        print('With --exec, queries are read one per line from the file (or')
+        print('stdin for -) and run as a batch. When stdin is not a terminal,')
+        print('eg when input is piped, batch mode is used even without --exec:')
+        print('there are no prompts and the program exits at the end of input.')
 
 
 if __name__ == '__main__':
     client = Client()
-    client.run_repl()
-
+    client.run()
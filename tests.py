@@ -1,6 +1,10 @@
+import contextlib
+import glob
+import io
 import os
 import pickle
 import unittest
+from unittest import mock
 
 import scratchdb
 
@@ -73,6 +77,19 @@ class FileStorageTest(unittest.TestCase):
             content = f.read()
         self.assertEqual(2, content.count(data))
 
+    def test_append_many(self):
+        fs = scratchdb.FileStorage(self.filename)
+        fs.append(b'first')
+        datas = [b'test value', b'other value', b'last']
+        addresses = fs.append_many(datas)
+        self.assertEqual(len(b'first') + fs.INTEGER_LENGTH, addresses[0])
+        for address, data in zip(addresses, datas):
+            self.assertEqual(data, fs.read(address))
+        self.assertEqual(addresses[2], fs.next_address(addresses[1]))
+        self.assertEqual(addresses[2] + len(b'last') + fs.INTEGER_LENGTH,
+                         fs.append(b'after'))
+        fs.close()
+
 
 class LogicalTest(unittest.TestCase):
     def setUp(self):
@@ -85,12 +102,9 @@ class LogicalTest(unittest.TestCase):
         self.delete_files()
 
     def delete_files(self):
-        for ext in ['.keys', '.values']:
-            filename = self.dbname + ext
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+        # compaction adds generation files next to .keys and .values
+        for filename in glob.glob(self.dbname + '.*'):
+            os.remove(filename)
 
     def test_init_opens_storage(self):
         keys_storage = self.instance._keys_storage
@@ -168,6 +182,192 @@ class LogicalTest(unittest.TestCase):
         for key, expected_value in expected.items():
             self.assertEqual(expected_value, self.instance.get(key))
 
+    def test_set_many_get_many(self):
+        items = [('key1', 'val1'), ((1, 3), [1, 2]), ('key1', 'val2')]
+        self.instance.set_many(items)
+        self.instance.pop((1, 3))
+        actual = self.instance.get_many(['key1', (1, 3), 'not-there'], default=-1)
+        self.assertEqual(['val2', -1, -1], actual)
+        self.assertEqual('val2', self.instance.get('key1'))
+
+    def test_get_many_matches_get(self):
+        self.instance.set([1], 'list value')
+        self.instance.set(1, 'int value')
+        self.assertEqual('list value', self.instance.get([1.0]))
+        self.assertEqual('int value', self.instance.get(1.0))
+        actual = self.instance.get_many([[1.0], 1.0, [2]])
+        self.assertEqual(['list value', 'int value', None], actual)
+
+    def test_set_many_ttl(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set_many([('key1', 'val1'), ('key2', 'val2')], ttl=10)
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.assertEqual([None, None], self.instance.get_many(['key1', 'key2']))
+            self.assertEqual(2, self.instance.expire())
+
+    def test_set_ttl(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('testkey', 'testvalue', ttl=10)
+        expected_key_bytes = pickle.dumps(('testkey', 0, 110))
+        actual_key_bytes = self.instance._keys_storage.read(0)
+        self.assertEqual(expected_key_bytes, actual_key_bytes)
+
+    def test_set_invalid_ttl(self):
+        with self.assertRaises(ValueError):
+            self.instance.set('testkey', 'testvalue', ttl=0)
+
+    def test_get_expired(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('testkey', 'testvalue', ttl=10)
+            self.instance.set('otherkey', 'othervalue')
+        with mock.patch.object(self.instance, '_now', return_value=109):
+            self.assertEqual('testvalue', self.instance.get('testkey'))
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            with mock.patch.object(self.instance._values_storage, 'read') as read:
+                with self.assertRaises(KeyError):
+                    self.instance.get('testkey')
+                read.assert_not_called()
+            self.assertEqual('othervalue', self.instance.get('otherkey'))
+
+    def test_set_without_ttl_clears_expiry(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('testkey', 'testvalue', ttl=10)
+            self.instance.set('testkey', 'newvalue')
+        with mock.patch.object(self.instance, '_now', return_value=200):
+            self.assertEqual('newvalue', self.instance.get('testkey'))
+
+    def test_expire(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('key1', 'val1', ttl=10)
+            self.instance.set('key2', 'val2', ttl=20)
+            self.instance.set('key3', 'val3', ttl=10)
+            self.instance.set('key4', 'val4')
+            self.instance.set(['key', 5], 'val5', ttl=10)
+        with mock.patch.object(self.instance, '_now', return_value=105):
+            self.assertEqual(0, self.instance.expire())
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.assertEqual(3, self.instance.expire())
+            keys = [k for k, *_ in self.instance._read_keys()]
+            self.assertEqual(['key2', 'key4'], keys)
+            self.assertEqual('val2', self.instance.get('key2'))
+            self.assertEqual('val4', self.instance.get('key4'))
+        with mock.patch.object(self.instance, '_now', return_value=120):
+            self.assertEqual(1, self.instance.expire())
+            self.assertEqual('val4', self.instance.get('key4'))
+
+    def test_init_does_not_read_keys(self):
+        self.instance.set('testkey', 'testvalue', ttl=10)
+        self.instance.close_storage()
+        with mock.patch.object(scratchdb.Logical, '_read_keys') as read_keys:
+            self.instance = scratchdb.Logical(self.dbname)
+            read_keys.assert_not_called()
+
+    def test_expire_does_not_count_popped(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('key1', 'val1', ttl=10)
+            self.instance.set('key2', 'val2')
+            self.instance.pop('key2')
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.assertEqual(1, self.instance.expire())
+            self.assertEqual([], self.instance._read_keys())
+
+    def test_set_expires_due_keys(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('key1', 'val1', ttl=10)
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.instance.set('key2', 'val2')
+            keys = [k for k, *_ in self.instance._read_keys()]
+            self.assertEqual(['key2'], keys)
+
+    def test_expire_failure_keeps_data(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('key1', 'val1', ttl=10)
+            self.instance.set('key2', 'val2')
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            with mock.patch.object(scratchdb.FileStorage, 'append_many',
+                                   side_effect=OSError):
+                with self.assertRaises(OSError):
+                    self.instance.expire()
+        self.assertEqual('val2', self.instance.get('key2'))
+        self.assertEqual(2, len(self.instance._read_keys()))
+        self.assertFalse(os.path.isfile(self.dbname + '.keys.1'))
+
+    def test_expire_interrupted_before_commit(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('x', 'xval', ttl=10)
+            self.instance.set('y', 'yval')
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            with mock.patch.object(self.instance, '_write_generation',
+                                   side_effect=OSError):
+                with self.assertRaises(OSError):
+                    self.instance.expire()
+            self.assertEqual('yval', self.instance.get('y'))
+        # files left behind by a compaction that died before committing
+        self.instance.close_storage()
+        for ext in ['.keys.1', '.values.1']:
+            with open(self.dbname + ext, 'wb') as f:
+                f.write(b'partial')
+        self.instance = scratchdb.Logical(self.dbname)
+        self.assertEqual('yval', self.instance.get('y'))
+        self.assertFalse(os.path.isfile(self.dbname + '.keys.1'))
+
+    def test_expire_interrupted_after_commit(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('x', 'xval', ttl=10)
+            self.instance.set('y', 'yval')
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            # the second call removes the files of the old generation
+            with mock.patch.object(self.instance, '_remove_files',
+                                   side_effect=[None, OSError]):
+                self.assertEqual(1, self.instance.expire())
+            self.assertEqual('yval', self.instance.get('y'))
+        self.assertTrue(os.path.isfile(self.dbname + '.keys'))
+        self.instance.close_storage()
+        self.instance = scratchdb.Logical(self.dbname)
+        self.assertEqual('yval', self.instance.get('y'))
+        self.assertEqual(['y'], [k for k, *_ in self.instance._read_keys()])
+        self.assertFalse(os.path.isfile(self.dbname + '.keys'))
+
+    def test_expire_matches_get_for_unhashable_keys(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set([1], 'a')
+            self.instance.pop([1.0])
+            self.instance.set([2], 'a')
+            self.instance.set([2.0], 'b')
+            self.instance.set([2], 'c')
+            self.instance.set('x', 'xval', ttl=10)
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.assertEqual(1, self.instance.expire())
+            with self.assertRaises(KeyError):
+                self.instance.get([1])
+            self.assertEqual('c', self.instance.get([2]))
+            self.assertEqual('c', self.instance.get([2.0]))
+
+    def test_stale_expiry_does_not_compact(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('key1', 'val1', ttl=10)
+            self.instance.set('key1', 'val2')
+            self.instance.set('key2', 'val2', ttl=10)
+            self.instance.pop('key2')
+            self.instance.set('key3', 'val3', ttl=10)
+            self.instance.set('key3', 'val3', ttl=20)
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            with mock.patch.object(self.instance, '_compact') as compact:
+                self.instance.set('key4', 'val4')
+                self.assertEqual(0, self.instance.expire())
+                compact.assert_not_called()
+
+    def test_expire_survives_reopen(self):
+        with mock.patch.object(self.instance, '_now', return_value=100):
+            self.instance.set('testkey', 'testvalue', ttl=10)
+        self.instance.close_storage()
+        self.instance = scratchdb.Logical(self.dbname)
+        with mock.patch.object(self.instance, '_now', return_value=110):
+            self.assertEqual(1, self.instance.expire())
+            self.assertEqual([], self.instance._read_keys())
+        expected = [self.dbname + ext for ext in ['.generation', '.keys.1', '.values.1']]
+        self.assertEqual(expected, sorted(glob.glob(self.dbname + '.*')))
+
 
 class ScratchDBAPITest(unittest.TestCase):
     def setUp(self):
@@ -180,12 +380,9 @@ class ScratchDBAPITest(unittest.TestCase):
         self.delete_files()
 
     def delete_files(self):
-        for ext in ['.keys', '.values']:
-            filename = self.dbname + ext
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+        # compaction adds generation files next to .keys and .values
+        for filename in glob.glob(self.dbname + '.*'):
+            os.remove(filename)
 
     def test_set_get(self):
         key = (1, 10)
@@ -206,6 +403,17 @@ class ScratchDBAPITest(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.db.get(key)
 
+    def test_set_ttl_expire(self):
+        key = (1, 10)
+        value = 'John Jones is 35 years old.'
+        with mock.patch('time.time', return_value=100):
+            self.db.set(key, value, ttl=60)
+            self.assertEqual(self.db.get(key), value)
+        with mock.patch('time.time', return_value=160):
+            with self.assertRaises(KeyError):
+                self.db.get(key)
+            self.assertEqual(1, self.db.expire())
+
 
 
 class QueryProcessorTest(unittest.TestCase):
@@ -220,12 +428,9 @@ class QueryProcessorTest(unittest.TestCase):
         self.delete_files()
 
     def delete_files(self):
-        for ext in ['.keys', '.values']:
-            filename = self.dbname + ext
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+        # compaction adds generation files next to .keys and .values
+        for filename in glob.glob(self.dbname + '.*'):
+            os.remove(filename)
 
     def test_invalid_comand(self):
         cmd_str = 'not (1,"bit") {"valid":False}'
@@ -298,6 +503,151 @@ class QueryProcessorTest(unittest.TestCase):
         expected_value = '10)[1,2,3]'
         self.assertEqual(self.db.get(expected_key), expected_value)
 
+    def test_empty_query(self):
+        for cmd_str in ['', '   ']:
+            actual = self.qp.execute(cmd_str)
+            self.assertEqual('Invalid query. The query is empty.', actual)
+
+    def test_missing_key(self):
+        actual = self.qp.execute('get')
+        self.assertTrue(actual.startswith('Invalid query. get should have a key'))
+
+    def test_execute_many(self):
+        cmd_strs = [
+            'set foo 1',
+            'set bar [1, 2]',
+            '',
+            'get foo',
+            'get bar',
+            'get baz',
+            'pop foo',
+            'get foo',
+            'set foo',
+            'set foo 3',
+            'get foo',
+        ]
+        expected = [
+            'Set key <str>: foo to <int>: 1',
+            'Set key <str>: bar to <list>: [1, 2]',
+            '<int>: 1',
+            '<list>: [1, 2]',
+            'Key not found: baz',
+            'Key popped: foo',
+            'Key not found: foo',
+            'Invalid query. set should have 2 arguments, the key to set and the value to set it to.',
+            'Set key <str>: foo to <int>: 3',
+            '<int>: 3',
+        ]
+        self.assertEqual(expected, self.qp.execute_many(cmd_strs))
+
+    def test_execute_many_matches_execute(self):
+        cmd_strs = ['set (1,10) [1, 2, 3]', 'get (1,10)', 'not a command', 'get nonexistent']
+        actual = self.qp.execute_many(cmd_strs)
+        self.db.close()
+        self.delete_files()
+        self.db = scratchdb.ScratchDB(self.dbname)
+        self.qp = scratchdb.QueryProcessor(self.db)
+        expected = [self.qp.execute(cmd_str) for cmd_str in cmd_strs]
+        self.assertEqual(expected, actual)
+
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.dbname = '__testdb'
+        self.cmds_filename = self.dbname + '.cmds'
+        self.delete_files()
+
+    def tearDown(self):
+        self.delete_files()
+
+    def delete_files(self):
+        for filename in glob.glob(self.dbname + '.*'):
+            os.remove(filename)
+
+    def write_cmds(self, content):
+        with open(self.cmds_filename, 'w') as f:
+            f.write(content)
+
+    def run_client(self, args, stdin_content='', isatty=False):
+        """
+        Runs the client with the given command line arguments and returns a
+        (exit code, stdout, stderr) tuple.
+        """
+        stdin = io.StringIO(stdin_content)
+        stdin.isatty = lambda: isatty
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with mock.patch('sys.argv', ['scratchdb.py'] + args), \
+                mock.patch('sys.stdin', stdin), \
+                contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            try:
+                scratchdb.Client().run()
+                code = 0
+            except SystemExit as e:
+                code = e.code
+        return code, stdout.getvalue(), stderr.getvalue()
+
+    def test_exec_file(self):
+        self.write_cmds('set foo 1\nget foo\n\nnot valid\n')
+        code, out, err = self.run_client([self.dbname, '--exec', self.cmds_filename])
+        self.assertEqual(0, code)
+        expected = [
+            'Set key <str>: foo to <int>: 1',
+            '<int>: 1',
+            'Invalid query. not is not a ScratchDB command.',
+        ]
+        self.assertEqual(expected, out.splitlines())
+        self.assertTrue(err.startswith('Processed 3 queries, invalid ones included, in '))
+
+    def test_exec_stdin(self):
+        code, out, err = self.run_client([self.dbname, '--exec', '-'], 'set foo 1\nget foo\n')
+        self.assertEqual(0, code)
+        self.assertEqual(['Set key <str>: foo to <int>: 1', '<int>: 1'], out.splitlines())
+        self.assertTrue(err.startswith('Processed 2 queries'))
+
+    def test_piped_stdin_runs_batch(self):
+        code, out, err = self.run_client([self.dbname], 'set foo 1\nget foo\n')
+        self.assertEqual(0, code)
+        self.assertEqual(['Set key <str>: foo to <int>: 1', '<int>: 1'], out.splitlines())
+        self.assertTrue(err.startswith('Processed 2 queries'))
+
+    def test_tty_stdin_runs_repl(self):
+        with mock.patch.object(scratchdb.Client, 'run_repl') as run_repl:
+            with mock.patch.object(scratchdb.Client, 'run_batch') as run_batch:
+                self.run_client([self.dbname], isatty=True)
+        run_repl.assert_called_once_with()
+        run_batch.assert_not_called()
+        scratchdb.ScratchDB(self.dbname).close()
+
+    def test_exec_missing_file(self):
+        code, out, err = self.run_client([self.dbname, '--exec', self.cmds_filename])
+        self.assertEqual(1, code)
+        self.assertEqual('', out)
+        self.assertTrue(err.startswith('Cannot read %s' % self.cmds_filename))
+
+    def test_exec_runs_in_batches(self):
+        self.write_cmds('set a 1\nset b 2\nset c 3\nget a\nget c\n')
+        execute_many = scratchdb.QueryProcessor.execute_many
+        with mock.patch.object(scratchdb.Client, 'BATCH_SIZE', 2), \
+                mock.patch.object(scratchdb.QueryProcessor, 'execute_many',
+                                  autospec=True, side_effect=execute_many) as mocked:
+            code, out, err = self.run_client([self.dbname, '--exec', self.cmds_filename])
+        self.assertEqual(3, mocked.call_count)
+        expected = [
+            'Set key <str>: a to <int>: 1',
+            'Set key <str>: b to <int>: 2',
+            'Set key <str>: c to <int>: 3',
+            '<int>: 1',
+            '<int>: 3',
+        ]
+        self.assertEqual(expected, out.splitlines())
+
+    def test_invalid_args(self):
+        code, out, err = self.run_client([self.dbname, '--exec'])
+        self.assertIsNone(code)
+        self.assertTrue(out.startswith('Usage:'))
 
 if __name__ == '__main__':
     unittest.main()